@@ -1,74 +1,338 @@
 import base64
+import hashlib
 import io
 import os
+import posixpath
+import re
+import threading
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from xml.sax.saxutils import escape
 
-from dash import Dash, dcc, html, Input, Output, State
-import pandas as pd
-from pptx import Presentation
+from dash import Dash, DiskcacheManager, dcc, html, Input, Output, State
+import diskcache
+from lxml import etree
 
 OUTPUT_FILE = "output.xlsx"
+MAX_UPLOAD_BYTES = 200 * 1024 * 1024  # largest decoded .pptx we will unpack in memory
+ZIP_MAGIC = b"PK\x03\x04"  # every .pptx is a zip, and a zip starts with these 4 bytes
+CACHE_DIR = ".cache"  # on-disk state shared by the web server and the background callback processes
+# Caching extracted results on disk is opt-in (CACHE_ENABLED=1), meant for development where the same deck is dropped
+# over and over. It writes every deck's extracted slide text to disk, so it stays off in production by default.
+CACHE_ENABLED = os.environ.get("CACHE_ENABLED", "").lower() in ("1", "true", "yes")
+CACHE_SIZE_LIMIT = 64 * 1024 * 1024  # bytes of extracted results we keep (see extract_fields_from_ppt)
+EXTRACTOR_VERSION = 1  # bump whenever the extraction logic changes, so results cached on disk by older code aren't reused
+
+PREFIXES = ["Assessment", "MSN", "ToT", "MGRS", "Country Code", "EEI", "Background", "Summary", "DTG"]  # one Excel column each
+COLUMNS = ["Slide"] + PREFIXES  # output columns, in order (Excel sheet and preview table)
+PREFIX_KEYS = [prefix.lower() + ":" for prefix in PREFIXES]  # what a shape's text has to start with (case-insensitive)
+# First 1 and 2 characters of every key. A shape's leading text can only lead to a label if its first two characters
+# (or its only character) are in here: one set lookup that turns away almost every shape before the per-key checks.
+PREFIX_STARTS = frozenset(key[:n] for key in PREFIX_KEYS for n in (1, 2))
+
+# "<prefix>:" at the start of a shape's text, one group per prefix so m.lastindex tells us which column it goes in.
+LABEL_PATTERN = re.compile("(?:" + "|".join(f"({re.escape(prefix)})" for prefix in PREFIXES) + "):", re.IGNORECASE)
+
+# Text content (between ">" and the next "<") containing a colon, matched against the raw slide XML bytes.
+# Every "<prefix>:" label needs a ":" in some <a:t>, so a slide without one can't have a label and we skip parsing it.
+# We don't look for the prefix words themselves: PowerPoint may split a word across runs ("Assess" + "ment: x"),
+# and then the word never appears in one piece in the XML. Colons inside tags (a:t, xmlns:...) aren't text, so they don't count.
+LABEL_COLON = re.compile(rb">[^<]*(?::|&#58;|&#x3[aA];)")
+
+A_NS = "{http://schemas.openxmlformats.org/drawingml/2006/main}"  # DrawingML namespace, where slide text (<a:t>) lives
+A_P = f"{A_NS}p"
+A_BR = f"{A_NS}br"
+P_NS = "{http://schemas.openxmlformats.org/presentationml/2006/main}"  # PresentationML: slide list, shape tree, shapes
+R_NS = "{http://schemas.openxmlformats.org/officeDocument/2006/relationships}"  # r:id attributes
+PKG_REL_NS = "{http://schemas.openxmlformats.org/package/2006/relationships}"  # *.rels files
+
+# XPath expressions are compiled once here and reused for every slide / shape.
+XPATH_NS = {
+    "a": "http://schemas.openxmlformats.org/drawingml/2006/main",
+    "p": "http://schemas.openxmlformats.org/presentationml/2006/main",
+}
+# <p:txBody> of each top-level text shape on a slide: the same shapes python-pptx gives for `slide.shapes` + `has_text_frame`
+# (text in group shapes and tables is not included).
+XP_TEXT_SHAPES = etree.XPath("p:cSld/p:spTree/p:sp/p:txBody", namespaces=XPATH_NS)
+# Text pieces of one <a:p>, in document order: run text, field text, and line breaks.
+XP_PARAGRAPH_TEXT = etree.XPath("a:r/a:t | a:fld/a:t | a:br", namespaces=XPATH_NS)
+
+# Cache key prefix: changes whenever the output columns or EXTRACTOR_VERSION change. The cache is on disk and outlives
+# the process, so without this an edit to PREFIXES would get old, misaligned columns back for a deck seen before.
+CACHE_SCHEMA = hashlib.blake2b(repr((EXTRACTOR_VERSION, COLUMNS)).encode(), digest_size=8).digest()
+
+# CACHE_SCHEMA + blake2b digest of the .pptx bytes -> extracted columns, or None when CACHE_ENABLED is off (no caching).
+# Uploads are processed in background callback processes (see below), so this has to live on disk to be shared between them;
+# diskcache handles locking and least-recently-used eviction.
+_cache = None
+if CACHE_ENABLED:
+    _cache = diskcache.Cache(os.path.join(CACHE_DIR, "extracted"), size_limit=CACHE_SIZE_LIMIT, eviction_policy="least-recently-used")
+
+_parsers = threading.local()  # an lxml parser instance parses one document at a time, so each worker thread gets its own
+
+# -------------------------------
+# Minimal XLSX container
+# -------------------------------
+# The output is one flat sheet, so we write the sheet XML ourselves instead of going through an Excel library.
+# These are the only parts Excel needs to open the file; sheet1.xml is built per upload in write_to_excel.
+
+XLSX_CONTENT_TYPES = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+    '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+    '<Default Extension="xml" ContentType="application/xml"/>'
+    '<Override PartName="/xl/workbook.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+    '<Override PartName="/xl/worksheets/sheet1.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+    '</Types>'
+)
+
+XLSX_ROOT_RELS = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+    '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="xl/workbook.xml"/>'
+    '</Relationships>'
+)
+
+XLSX_WORKBOOK = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+    'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+    '<sheets><sheet name="Sheet1" sheetId="1" r:id="rId1"/></sheets>'
+    '</workbook>'
+)
+
+XLSX_WORKBOOK_RELS = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+    '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" Target="worksheets/sheet1.xml"/>'
+    '</Relationships>'
+)
+
+XLSX_SHEET_HEAD = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><sheetData>'
+)
+
+XLSX_SHEET_TAIL = '</sheetData></worksheet>'
+
+ILLEGAL_XML_CHARS = re.compile(r"[\x00-\x08\x0b\x0c\x0e-\x1f]")  # not allowed in XML 1.0
 
 # -------------------------------
 # Backend logic
 # -------------------------------
 
+def xml_parser():
+    """
+    This thread's lxml parser (same settings python-pptx parses with).
+    """
+    parser = getattr(_parsers, "parser", None)
+    if parser is None:
+        parser = _parsers.parser = etree.XMLParser(remove_blank_text=True, resolve_entities=False)
+    return parser
+
+
+def slide_part_names(z):
+    """
+    z: open ZipFile of the .pptx
+    Returns the slide part names (e.g. "ppt/slides/slide3.xml") in presentation order.
+    The order comes from <p:sldIdLst> in presentation.xml, not the file names, so reordered decks come out right.
+    """
+    rels = etree.fromstring(z.read("ppt/_rels/presentation.xml.rels"), xml_parser())
+    targets = {rel.get("Id"): rel.get("Target") for rel in rels.iter(f"{PKG_REL_NS}Relationship")}
+
+    presentation = etree.fromstring(z.read("ppt/presentation.xml"), xml_parser())
+    names = []
+    for sld_id in presentation.iter(f"{P_NS}sldId"):
+        target = targets[sld_id.get(f"{R_NS}id")]
+        if target.startswith("/"):  # absolute part name
+            names.append(target[1:])
+        else:  # relative to ppt/
+            names.append(posixpath.normpath(posixpath.join("ppt", target)))
+    return names
+
+
+def leading_text(tx_body):
+    """
+    Returns the first non-blank <a:t> text of a shape (lowercased, left-stripped), or "" if the shape has no text.
+    Only touches the XML up to the first real text instead of building the full shape text for every shape.
+    """
+    for t in tx_body.iter(f"{A_NS}t"):
+        head = (t.text or "").lstrip()
+        if head:
+            return head.lower()
+    return ""
+
+
+def shape_text(tx_body):
+    """
+    Full text of a shape, built the same way as python-pptx's shape.text:
+    paragraphs joined by "\n", runs and fields concatenated, line breaks as "\v".
+    """
+    return "\n".join(
+        "".join("\v" if piece.tag == A_BR else (piece.text or "") for piece in XP_PARAGRAPH_TEXT(p))
+        for p in tx_body.iterchildren(A_P)
+    )
+
+
+def extract_slide_fields(xml):
+    """
+    xml: raw bytes of the slide part, or None if the slide was already ruled out (no LABEL_COLON match)
+    Returns this slide's value for each prefix, in PREFIXES order ("" where the slide has none).
+    """
+    values = [""] * len(PREFIXES)  # one slot per prefix column
+
+    if xml is None:  # no colon in any text on this slide, so no label -> keep the empty values, skip the XML parse
+        return values
+
+    # loop through the text shapes in the slide (shapes without a text frame are already skipped)
+    for tx_body in XP_TEXT_SHAPES(etree.fromstring(xml, xml_parser())):
+        head = leading_text(tx_body)
+        # cheap reject: first text run can't be the start of any "<prefix>:". A run may hold only part of the prefix,
+        # e.g. runs "Assess" + "ment: x" -> head "assess", which must still get through, so allow both ways.
+        if not head or head[:2] not in PREFIX_STARTS:
+            continue
+        if not any(key.startswith(head) or head.startswith(key) for key in PREFIX_KEYS):
+            continue
+
+        text = shape_text(tx_body).strip()
+        label = LABEL_PATTERN.match(text)  # one C-level match instead of lowercasing the text once per prefix
+        if label is None:
+            continue
+
+        i = label.lastindex - 1  # which prefix matched
+        value = text[label.end():].strip()
+
+        if values[i]: 
+            values[i] += "\n" + value
+        else:
+            values[i] = value
+
+    return values
+
+
 def extract_fields_from_ppt(contents):
     """
     contents: base64-encoded file contents from Dash Upload component
+    Returns one list per output column (aligned with COLUMNS): slide numbers first, then each prefix's values.
     """
-    content_type, content_string = contents.split(',')  # HTML file uploads come in 2 parts : data:<mime-type>; base64,<data>. We just want the data.
-    decoded = base64.b64decode(content_string)
-
-    prs = Presentation(io.BytesIO(decoded)) # from Presentation import
-                                            # this reads ppt/presentation.xml, slides1.xml, ppt/media/* etc.. and 
-                                            # Builds Python objects for Presentation, SLides, Shapes, Text frames, Layouts, Masters, Relationships
+    start = contents.index(",") + 1  # HTML file uploads come in 2 parts : data:<mime-type>; base64,<data>. We just want the data.
+
+    # Every 4 base64 chars decode to 3 bytes, so we can turn away an oversized upload from its length alone,
+    # before slicing (copying) or decoding any of it.
+    estimated_size = (len(contents) - start) // 4 * 3
+    if estimated_size > MAX_UPLOAD_BYTES:
+        raise ValueError(f"File is too large ({estimated_size // (1024 * 1024)} MB, limit is {MAX_UPLOAD_BYTES // (1024 * 1024)} MB).")
+
+    content_string = contents[start:]
+    decoded = base64.b64decode(content_string, validate=True)  # fail fast on a corrupt upload instead of handing junk to zipfile
+
+    if len(decoded) > MAX_UPLOAD_BYTES:  # exact size (the estimate above can be a couple of bytes high because of padding)
+        raise ValueError(f"File is too large ({len(decoded) // (1024 * 1024)} MB, limit is {MAX_UPLOAD_BYTES // (1024 * 1024)} MB).")
+
+    # Dropping the same file again re-fires the callback; if we've seen these exact bytes, reuse the columns we extracted last time.
+    # (Only with CACHE_ENABLED; see the top of the file.)
+    if _cache is not None:
+        key = CACHE_SCHEMA + hashlib.blake2b(decoded, digest_size=16).digest()
+        columns = _cache.get(key)
+        if columns is not None:
+            return columns
+
+    # A .pptx is a zip of XML parts. We only need ppt/presentation.xml (slide order) and the ppt/slides/slideN.xml parts,
+    # so we read those directly instead of loading the whole deck (layouts, masters, media, ...) through python-pptx.
+    # Slides with no colon in their text are ruled out as soon as they're read, so only candidate slides are kept in memory.
+    with zipfile.ZipFile(io.BytesIO(decoded)) as z:
+        slide_xml = []
+        for name in slide_part_names(z):
+            xml = z.read(name)
+            slide_xml.append(xml if LABEL_COLON.search(xml) else None)
     
-    prefixes = ["Assessment", "MSN", "ToT", "MGRS", "Country Code", "EEI", "Background", "Summary", "DTG"]
-    
-    results = []
+    # Each slide is independent and lxml lets go of the GIL while parsing, so slides are handled on a thread pool.
+    # Only plain bytes (or None) go to the workers (ZipFile is closed by now); map() keeps the results in slide order.
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as pool:
+        slide_values = list(pool.map(extract_slide_fields, slide_xml))
+
+    # Turn the per-slide values into columns: the preview table and the Excel writer both consume columns,
+    # so we never build a dict per row.
+    slides = list(range(1, len(slide_xml) + 1))
+    columns = [slides] + ([list(column) for column in zip(*slide_values)] or [[] for _ in PREFIXES])
 
-    # loop through each slide
-    for slide_number, slide in enumerate(prs.slides, start=1):
+    if _cache is not None:
+        _cache.set(key, columns)
 
-        row = {"Slide": slide_number}  # dictionary with slide numbers   
+    return columns
 
-        for prefix in prefixes:  # create the columns
-            row[prefix] = ""
 
-        # loop through shape in each slide    
-        for shape in slide.shapes:
-            if not shape.has_text_frame:  # if no text on the slide go to the next shape on the slide.
-                continue
+def column_letter(index):
+    """
+    index: 0-based column index -> Excel column letters (0 -> A, 25 -> Z, 26 -> AA)
+    """
+    letters = ""
+    index += 1
+    while index:
+        index, rem = divmod(index - 1, 26)
+        letters = chr(65 + rem) + letters
+    return letters
 
-            text = shape.text.strip()
-            if not text:  # after stripping whiteespace if nothing is left, go to the next slide.
-                continue
 
-           
-            for prefix in prefixes:
-                if text.lower().startswith(prefix.lower() + ":"):
-                    value = text[len(prefix) + 1 :].strip()
+def xlsx_cell(ref, value):
+    if isinstance(value, int):  # slide numbers stay numeric
+        return f'<c r="{ref}"><v>{value}</v></c>'
+    if not value:  # leave empty cells out, same as Excel does
+        return ""
+    # "\v" is how a pptx line break comes out; it isn't legal XML, but "\n" is and Excel shows it as a line break.
+    text = escape(ILLEGAL_XML_CHARS.sub(" ", value.replace("\v", "\n")))
+    return f'<c r="{ref}" t="inlineStr"><is><t xml:space="preserve">{text}</t></is></c>'
 
-                    if row[prefix]: 
-                        row[prefix] += "\n" + value
-                    else:
-                        row[prefix] = value
+
+def write_to_excel(columns):
+    """
+    columns: column lists from extract_fields_from_ppt (aligned with COLUMNS)
+    """
+    # Write to a temp file next to the output and swap it in with os.replace (atomic), so a concurrent upload
+    # or someone opening the file never sees a half-written workbook. pid + thread id keeps concurrent writers apart.
+    tmp = f"{OUTPUT_FILE}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        write_xlsx(tmp, columns)
+        os.replace(tmp, OUTPUT_FILE)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
 
 
-        results.append(row)
-    return results
+def write_xlsx(path, columns):
+    """
+    path: where to write the .xlsx
+    columns: column lists from extract_fields_from_ppt (aligned with COLUMNS)
+    """
+    letters = [column_letter(i) for i in range(len(COLUMNS))]
+    rows = [COLUMNS, *zip(*columns)]  # header row first, then one row per slide
 
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as z:
+        z.writestr("[Content_Types].xml", XLSX_CONTENT_TYPES)
+        z.writestr("_rels/.rels", XLSX_ROOT_RELS)
+        z.writestr("xl/workbook.xml", XLSX_WORKBOOK)
+        z.writestr("xl/_rels/workbook.xml.rels", XLSX_WORKBOOK_RELS)
 
-def write_to_excel(data):
-    df = pd.DataFrame(data)
-    df.to_excel(OUTPUT_FILE, index=False, engine="openpyxl")
+        # Stream the sheet row by row into the compressor (same idea as xlsxwriter's constant_memory mode),
+        # so the whole sheet XML is never held in memory as one string.
+        with z.open("xl/worksheets/sheet1.xml", "w") as sheet:
+            sheet.write(XLSX_SHEET_HEAD.encode())
+            for r, values in enumerate(rows, start=1):
+                cells = "".join(xlsx_cell(f"{letter}{r}", value) for letter, value in zip(letters, values))
+                sheet.write(f'<row r="{r}">{cells}</row>'.encode())
+            sheet.write(XLSX_SHEET_TAIL.encode())
 
 
 # -------------------------------
 # Dash App
 # -------------------------------
 
-app = Dash(__name__)
+# Uploads are processed as background callbacks: each one runs in its own worker process, so the web server answers
+# right away ("Processing...") and several uploads are parsed in parallel instead of holding up the server.
+background_callback_manager = DiskcacheManager(diskcache.Cache(os.path.join(CACHE_DIR, "callbacks")))
+
+app = Dash(__name__, background_callback_manager=background_callback_manager)
 
 app.layout = html.Div(
     style={
@@ -118,33 +382,41 @@ app.layout = html.Div(
 @app.callback(
     Output("status-message", "children"),  # See Notes at bottom for details on these callbacks.
     Output("preview-table", "children"),
+    Output("upload-ppt", "contents"),      # cleared once we're done with the file (see Notes at bottom)
     Input("upload-ppt", "contents"),        
     State("upload-ppt", "filename"),
+    background=True,
+    running=[(Output("status-message", "children"), "Processing...", "")],
     prevent_initial_call=True
 )
 def process_upload(contents, filename): # func is called from callback trigger.  Contents passes to 'extract_assess..."
     if contents is None:
-        return "", ""
+        return "", "", None
 
     if not filename.lower().endswith(".pptx"):
-        return html.Div("Please upload a .pptx file.", style={"color": "red"}), ""
+        return html.Div("Please upload a .pptx file.", style={"color": "red"}), "", None
 
     try:
-        data = extract_fields_from_ppt(contents)  # func is called from callback trigger.  Contents passes to 'extract_assess..."
+        # Peek at the first bytes before touching the rest of the upload: 12 base64 chars -> 9 bytes, enough for the zip signature.
+        # The 12 chars are sliced straight out of `contents`, so nothing else is copied or decoded; a renamed non-pptx file
+        # is turned away here before extract_fields_from_ppt decodes (possibly) megabytes of base64.
+        i = contents.find(",")
+        if base64.b64decode(contents[i + 1:i + 13])[:4] != ZIP_MAGIC:
+            return html.Div("Not a valid .pptx file.", style={"color": "red"}), "", None
 
-        if not data:
+        columns = extract_fields_from_ppt(contents)  # func is called from callback trigger.  Contents passes to 'extract_assess..."
+
+        if not columns[0]:  # no slides
             return html.Div(
                 "No data found in this presentation.",
                 style={"color": "orange"}
-            ), ""
-
-        write_to_excel(data)  # *** FUTURE CHANGE *** Calls the function to write to excel. Prob want to write to Dataset in Palantir.
+            ), "", None
 
-        df = pd.DataFrame(data)  # Need this here for the return below which prints the output in the browser.
+        write_to_excel(columns)  # *** FUTURE CHANGE *** Calls the function to write to excel. Prob want to write to Dataset in Palantir.
 
         return (
             html.Div(
-                f"Successfully extracted {len(data)} assessments. Excel file overwritten: {OUTPUT_FILE}",
+                f"Successfully extracted {len(columns[0])} assessments. Excel file overwritten: {OUTPUT_FILE}",
                 style={"color": "green"}
             ),
             dcc.Graph(  # simple table preview
@@ -152,21 +424,22 @@ def process_upload(contents, filename): # func is called from callback trigger.
                     "data": [{
                         "type": "table",
                         "header": {
-                            "values": list(df.columns),
+                            "values": COLUMNS,
                             "align": "left"
                         },
                         "cells": {
-                            "values": [df[col] for col in df.columns],
+                            "values": columns,  # table wants one list per column, which is what we already have
                             "align": "left"
                         }
                     }],
                     "layout": {"margin": {"t": 10}}
                 }
-            )
+            ),
+            None
         )
 
     except Exception as e:
-        return html.Div(f"Error: {str(e)}", style={"color": "red"}), ""
+        return html.Div(f"Error: {str(e)}", style={"color": "red"}), "", None
 
 
 # -------------------------------
@@ -184,8 +457,13 @@ if __name__ == "__main__":
 # -- Dash comes with dcc.Upload button which we named "upload-ppt".  We'll use this dcc.Upload to drop our pptx files.
 
 #    Output("status-message", "children"),  -Component of app.Layout = html.Div(stlyes[], children[html.Div, dcc.Upload(*ox to upload),...]
-#                                           - This "Output" is for the text feedback to the user (1 upload 2 outputs)
-#    Output("preview-table", "children"),   - This "Output" is for the preview table in the website (1 upload 2 outputs)
+#                                           - This "Output" is for the text feedback to the user (1 upload 3 outputs)
+#    Output("preview-table", "children"),   - This "Output" is for the preview table in the website (1 upload 3 outputs)
+#    Output("upload-ppt", "contents"),      - Every return sets contents back to None. Otherwise the whole base64 file stays in browser
+#                                           - memory and gets sent again with every callback. Also lets the same file be dropped again.
+#                                           - (A callback updating its own Input doesn't re-trigger itself.)
 #    Input("upload-ppt", "contents"),        
 #    State("upload-ppt", "filename"),
+#    background=True                        -- Runs the callback in a separate worker process (DiskcacheManager) instead of the web server
+#    running=[(Output(...), "Processing...", "")] -- Shows "Processing..." in the status message while the background job runs
 #    prevent_initial_call=True              -- This prevents the function from executing upon initial load 